@@ -0,0 +1,375 @@
+"""Offline bulk scoring of image directories and archives.
+
+Reuses the API's model loading and preprocessing so results match /predict.
+Images are decoded across a process pool while the model scores the
+previous batch, and every finished batch is appended to a checkpoint file
+so an interrupted run resumes where it stopped. Tar archives are read in a
+single forward pass in archive order, so compressed archives are only
+decompressed once.
+
+Example:
+    python batch_score.py ../captured_images ../test_images_from_internet --output scores.csv
+    python batch_score.py fleet_archive.tar.gz --output scores.parquet --mongo
+
+Parquet output requires pandas and pyarrow.
+"""
+import argparse
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import tarfile
+import time
+import uuid
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import lru_cache
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+from pymongo import ReplaceOne
+
+import main
+
+logger = logging.getLogger("batch_score")
+
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz")
+ARCHIVE_SEPARATOR = "::"  # Separates archive path from member name in a source id
+DEFAULT_BATCH_SIZE = 128
+
+def is_archive(path: str) -> bool:
+    """Check if the path is a supported archive"""
+    return path.lower().endswith(ARCHIVE_SUFFIXES)
+
+@lru_cache(maxsize=None)
+def is_zip_archive(path: str) -> bool:
+    return zipfile.is_zipfile(path)
+
+def is_tar_source(source: str) -> bool:
+    """Check if the source id names a member of a tar archive"""
+    return ARCHIVE_SEPARATOR in source and not is_zip_archive(source.split(ARCHIVE_SEPARATOR, 1)[0])
+
+def list_sources(paths: List[str]) -> List[str]:
+    """Expand files, directories and archives into a list of image source ids.
+    
+    Directory files and zip members are sorted by name; tar members keep
+    their archive order so they can be read in one forward pass.
+    """
+    sources = []
+    for path in paths:
+        if os.path.isdir(path):
+            found = []
+            for root, _, files in os.walk(path):
+                for name in files:
+                    if main.is_valid_file_type(name):
+                        found.append(os.path.join(root, name))
+            sources.extend(sorted(found))
+        elif zipfile.is_zipfile(path):
+            with zipfile.ZipFile(path) as archive:
+                sources.extend(sorted(
+                    f"{path}{ARCHIVE_SEPARATOR}{name}"
+                    for name in archive.namelist()
+                    if main.is_valid_file_type(name)
+                ))
+        elif is_archive(path):
+            with tarfile.open(path, "r|*") as archive:
+                sources.extend(
+                    f"{path}{ARCHIVE_SEPARATOR}{member.name}"
+                    for member in archive
+                    if member.isfile() and main.is_valid_file_type(member.name)
+                )
+        elif main.is_valid_file_type(path):
+            sources.append(path)
+        else:
+            logger.warning(f"Skipping unsupported path: {path}")
+    return sources
+
+class SourceReader:
+    """Read image bytes from files or zip members, keeping zip archives open"""
+
+    def __init__(self):
+        self._archives: Dict[str, zipfile.ZipFile] = {}
+
+    def read(self, source: str) -> bytes:
+        if ARCHIVE_SEPARATOR not in source:
+            with open(source, "rb") as f:
+                return f.read()
+        path, name = source.split(ARCHIVE_SEPARATOR, 1)
+        if path not in self._archives:
+            self._archives[path] = zipfile.ZipFile(path)
+        return self._archives[path].read(name)
+
+    def close(self):
+        for archive in self._archives.values():
+            archive.close()
+        self._archives.clear()
+
+class TarStreamReader:
+    """Read tar members in archive order with one forward stream per archive.
+    
+    Members must be requested in the order list_sources returned them;
+    members in between (e.g. already checkpointed ones) are skipped without
+    seeking back, so a .tar.gz is decompressed once.
+    """
+
+    def __init__(self):
+        self._archives: Dict[str, tarfile.TarFile] = {}
+        self._members: Dict[str, Iterator[tarfile.TarInfo]] = {}
+
+    def read(self, source: str) -> bytes:
+        path, name = source.split(ARCHIVE_SEPARATOR, 1)
+        if path not in self._archives:
+            self._archives[path] = tarfile.open(path, "r|*")
+            self._members[path] = iter(self._archives[path])
+        for member in self._members[path]:
+            if member.name == name:
+                return self._archives[path].extractfile(member).read()
+        raise KeyError(f"{name} not found in {path} after the previous member")
+
+    def close(self):
+        for archive in self._archives.values():
+            archive.close()
+        self._archives.clear()
+        self._members.clear()
+
+# Each decode worker opens its own zip handles on first use
+_WORKER_READER: Optional[SourceReader] = None
+
+def decode_source(task: Tuple[str, Optional[bytes], Optional[str]]) -> Tuple[Optional[np.ndarray], Optional[str]]:
+    """Read, validate and preprocess one image in a worker process, returning the array or an error.
+    
+    The task carries the source id plus the bytes or read error of tar
+    members, which the parent streams; other sources are read here.
+    """
+    global _WORKER_READER
+    source, contents, error = task
+    if error is not None:
+        return None, error
+    if _WORKER_READER is None:
+        _WORKER_READER = SourceReader()
+    try:
+        if contents is None:
+            contents = _WORKER_READER.read(source)
+        # Same header checks as the API: image dimensions, or .npy shape and dtype
+        main.validate_image_header(contents)
+        return main.preprocess_image(contents), None
+    except Exception as e:
+        return None, getattr(e, "detail", None) or str(e)
+
+def read_checkpoint(path: str) -> Iterator[Dict[str, Any]]:
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def truncate_partial_line(path: str, block_size: int = 64 * 1024):
+    """Cut off a last line left incomplete by a run killed in the middle of a write"""
+    with open(path, "rb+") as f:
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            start = max(0, position - block_size)
+            f.seek(start)
+            newline = f.read(position - start).rfind(b"\n")
+            if newline != -1:
+                position = start + newline + 1
+                break
+            position = start
+        if position < end:
+            logger.warning(f"Dropping {end - position} bytes of an incomplete record from {path}")
+            f.truncate(position)
+
+def load_checkpoint(path: str) -> Tuple[str, Set[str]]:
+    """Return the run id and the sources already scored, starting a new run if there is no checkpoint"""
+    run_id, done = None, set()
+    if os.path.exists(path):
+        truncate_partial_line(path)
+        for record in read_checkpoint(path):
+            if "run_id" in record:
+                run_id = record["run_id"]
+            else:
+                done.add(record["source"])
+    if run_id is None:
+        run_id = uuid.uuid4().hex
+        with open(path, "a") as f:
+            f.write(json.dumps({"run_id": run_id}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+    return run_id, done
+
+def score_batch(batch: List[np.ndarray], buffer: np.ndarray) -> np.ndarray:
+    """Score a batch with the full model and calibrate the confidences like /predict"""
+    predictions, _ = main.run_full_model(np.stack(batch, out=buffer[:len(batch)]))
+    return main.calibrate_probabilities(predictions)
+
+def build_records(
+    sources: List[str],
+    decoded: List[Tuple[Optional[np.ndarray], Optional[str]]],
+    buffer: np.ndarray
+) -> List[Dict[str, Any]]:
+    """Score the decoded images of one batch and build a result record per source"""
+    valid = [i for i, (image, _) in enumerate(decoded) if image is not None]
+    probabilities = score_batch([decoded[i][0] for i in valid], buffer) if valid else []
+    scored = dict(zip(valid, probabilities))
+
+    records = []
+    for i, source in enumerate(sources):
+        record = {"source": source, "predicted_class": None, "confidence": None,
+                  "class_confidences": None, "error": decoded[i][1]}
+        if i in scored:
+            record["predicted_class"] = main.CLASS_NAMES[int(np.argmax(scored[i]))]
+            record["confidence"] = float(np.max(scored[i]))
+            record["class_confidences"] = {
+                class_name: float(conf)
+                for class_name, conf in zip(main.CLASS_NAMES, scored[i])
+            }
+        records.append(record)
+    return records
+
+def insert_into_mongodb(records: List[Dict[str, Any]], run_id: str):
+    """Bulk upsert successful records into the predictions collection.
+    
+    Records are keyed by run id and source, so a batch replayed after a crash
+    between the insert and the checkpoint write does not create duplicates.
+    """
+    documents = [
+        {
+            "batch_key": f"{run_id}:{record['source']}",
+            "predicted_class": record["predicted_class"],
+            "confidence": record["confidence"],
+            "class_confidences": record["class_confidences"],
+            "file_metadata": {"filename": record["source"]},
+            "processing_details": {
+                "batch_scoring": True,
+                "batch_run_id": run_id,
+                "calibration_temperature": main.CALIBRATION_TEMPERATURE
+            },
+            "timestamp": datetime.utcnow()
+        }
+        for record in records
+        if record["error"] is None
+    ]
+    if documents:
+        main.get_database()["predictions"].bulk_write(
+            [ReplaceOne({"batch_key": document["batch_key"]}, document, upsert=True) for document in documents],
+            ordered=False
+        )
+
+def write_output(checkpoint_path: str, output_path: str):
+    """Write all checkpointed records to CSV or Parquet"""
+    columns = ["source", "predicted_class", "confidence", *main.CLASS_NAMES, "error"]
+    rows = []
+    for record in read_checkpoint(checkpoint_path):
+        if "source" not in record:
+            continue
+        row = {key: record[key] for key in ("source", "predicted_class", "confidence", "error")}
+        row.update(record["class_confidences"] or {})
+        rows.append(row)
+
+    if output_path.lower().endswith(".parquet"):
+        try:
+            import pandas as pd
+        except ImportError:
+            raise RuntimeError("Parquet output requires pandas and pyarrow (pip install pandas pyarrow)")
+        pd.DataFrame(rows, columns=columns).to_parquet(output_path, index=False)
+    else:
+        with open(output_path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(rows)
+    logger.info(f"Wrote {len(rows)} results to {output_path}")
+
+def format_eta(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:d}:{minutes:02d}:{seconds:02d}"
+
+def run(args: argparse.Namespace):
+    checkpoint_path = args.checkpoint or f"{args.output or 'batch_score'}.checkpoint.jsonl"
+    if args.restart and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    sources = list_sources(args.paths)
+    run_id, done = load_checkpoint(checkpoint_path)
+    pending = [source for source in sources if source not in done]
+    logger.info(f"Found {len(sources)} images, {len(done)} already scored, {len(pending)} to go")
+
+    # Fork the decode workers before TensorFlow initializes its runtime
+    pool = ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("fork"))
+    pool.submit(int).result()
+
+    main.get_model()
+    if args.mongo:
+        main.init_mongodb()
+        if main.get_database() is None:
+            raise RuntimeError("MongoDB not available")
+        main.get_database()["predictions"].create_index("batch_key", unique=True, sparse=True)
+
+    # Decoded images are stacked into one reusable uint8 batch buffer
+    batch_buffer = np.empty((args.batch_size, *main.MODEL_INPUT_SIZE, 3), dtype=np.uint8)
+    batches = [pending[i:i + args.batch_size] for i in range(0, len(pending), args.batch_size)]
+    tar_reader = TarStreamReader()
+
+    def prepare(source: str) -> Tuple[str, Optional[bytes], Optional[str]]:
+        if not is_tar_source(source):
+            return source, None, None
+        try:
+            return source, tar_reader.read(source), None
+        except Exception as e:
+            return source, None, str(e)
+
+    def submit(batch: List[str]):
+        return pool.map(decode_source, [prepare(source) for source in batch], chunksize=8)
+
+    start_time = time.perf_counter()
+    scored = 0
+    try:
+        with open(checkpoint_path, "a") as checkpoint:
+            # Decode the next batch while the model scores the current one
+            next_decoded = submit(batches[0]) if batches else None
+            for index, batch in enumerate(batches):
+                decoded = list(next_decoded)
+                if index + 1 < len(batches):
+                    next_decoded = submit(batches[index + 1])
+
+                records = build_records(batch, decoded, batch_buffer)
+                if args.mongo:
+                    insert_into_mongodb(records, run_id)
+                # One write per batch, synced, so a kill leaves at most a partial last line
+                checkpoint.write("".join(json.dumps(record) + "\n" for record in records))
+                checkpoint.flush()
+                os.fsync(checkpoint.fileno())
+
+                scored += len(batch)
+                elapsed = time.perf_counter() - start_time
+                rate = scored / elapsed
+                eta = (len(pending) - scored) / rate
+                logger.info(
+                    f"{len(done) + scored}/{len(sources)} images, "
+                    f"{rate:.1f} images/sec, ETA {format_eta(eta)}"
+                )
+    finally:
+        tar_reader.close()
+        pool.shutdown()
+
+    if args.output:
+        write_output(checkpoint_path, args.output)
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Score image directories and archives with the potato disease model")
+    parser.add_argument("paths", nargs="+", help="Image files, directories, or .zip/.tar/.tar.gz archives")
+    parser.add_argument("--output", help="Write results to this .csv or .parquet file")
+    parser.add_argument("--mongo", action="store_true", help="Bulk insert results into the MongoDB predictions collection")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Images per model call")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Decode worker processes")
+    parser.add_argument("--checkpoint", help="Checkpoint file (default: <output>.checkpoint.jsonl)")
+    parser.add_argument("--restart", action="store_true", help="Ignore any existing checkpoint and score everything again")
+    args = parser.parse_args(argv)
+    if not args.output and not args.mongo:
+        parser.error("at least one of --output or --mongo is required")
+    return args
+
+if __name__ == "__main__":
+    run(parse_args())
@@ -0,0 +1,99 @@
+"""Fit the confidence calibration temperature offline.
+
+Scores a labelled hold-out set with the full model (without calibration)
+and prints the temperature to set as CALIBRATION_TEMPERATURE. The directory
+must contain one sub-folder per class whose name ends with the class name,
+such as the PlantVillage "Potato___Early_blight", "Potato___Late_blight" and
+"Potato___healthy" folders.
+
+The fit uses one view per image. With tta=true the API applies the same
+temperature to each flipped view before averaging, so one temperature
+serves both modes.
+
+Example:
+    python calibrate.py ../data/validation
+"""
+import argparse
+import logging
+import os
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+import main
+
+logger = logging.getLogger("calibrate")
+
+def class_index(folder: str) -> Optional[int]:
+    """Match a dataset folder name to an index in CLASS_NAMES"""
+    normalized = folder.lower().replace(" ", "_")
+    for index, class_name in enumerate(main.CLASS_NAMES):
+        if normalized.endswith(class_name.lower().replace(" ", "_")):
+            return index
+    return None
+
+def list_labelled_images(directory: str) -> List[Tuple[str, int]]:
+    """Collect (path, label) pairs from the class sub-folders of a directory"""
+    images = []
+    for folder in sorted(os.listdir(directory)):
+        label = class_index(folder)
+        folder_path = os.path.join(directory, folder)
+        if label is None or not os.path.isdir(folder_path):
+            logger.warning(f"Skipping {folder_path}: not a class folder")
+            continue
+        for root, _, files in os.walk(folder_path):
+            images.extend((os.path.join(root, name), label) for name in sorted(files) if main.is_valid_file_type(name))
+    return images
+
+def score_images(images: List[Tuple[str, int]], batch_size: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Return the uncalibrated model probabilities and labels of the readable images"""
+    main.get_model()
+    buffer = np.empty((batch_size, *main.MODEL_INPUT_SIZE, 3), dtype=np.uint8)
+    probabilities, labels = [], []
+
+    for start in range(0, len(images), batch_size):
+        filled = 0
+        for path, label in images[start:start + batch_size]:
+            try:
+                with open(path, "rb") as f:
+                    main.preprocess_image(f.read(), out=buffer[filled])
+            except Exception as e:
+                logger.warning(f"Skipping {path}: {str(e)}")
+                continue
+            labels.append(label)
+            filled += 1
+        if filled:
+            predictions, _ = main.run_full_model(buffer[:filled])
+            probabilities.append(predictions.astype(np.float64))
+        logger.info(f"Scored {min(start + batch_size, len(images))}/{len(images)} images")
+
+    return np.concatenate(probabilities), np.asarray(labels)
+
+def negative_log_likelihood(probabilities: np.ndarray, labels: np.ndarray) -> float:
+    picked = probabilities[np.arange(len(labels)), labels]
+    return float(-np.mean(np.log(np.clip(picked, 1e-12, 1.0))))
+
+def run(args: argparse.Namespace):
+    images = list_labelled_images(args.directory)
+    if not images:
+        raise SystemExit(f"No labelled images found in {args.directory}")
+    logger.info(f"Found {len(images)} labelled images")
+
+    probabilities, labels = score_images(images, args.batch_size)
+    temperature = main.fit_temperature(probabilities, labels)
+    calibrated = main.calibrate_probabilities(probabilities, temperature)
+
+    print(f"Images:       {len(labels)}")
+    print(f"Accuracy:     {np.mean(np.argmax(probabilities, axis=-1) == labels):.4f}")
+    print(f"NLL before:   {negative_log_likelihood(probabilities, labels):.4f}")
+    print(f"NLL after:    {negative_log_likelihood(calibrated, labels):.4f}")
+    print(f"CALIBRATION_TEMPERATURE={temperature:.4f}")
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Fit the temperature used to calibrate prediction confidences")
+    parser.add_argument("directory", help="Hold-out set with one sub-folder per class")
+    parser.add_argument("--batch-size", type=int, default=main.BATCH_SIZE, help="Images per model call")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    run(parse_args())
@@ -0,0 +1,312 @@
+"""Approximate nearest-neighbour index over prediction embeddings.
+
+Vectors are L2-normalized and appended as float16 to a memory-mapped log,
+so the index survives restarts. Until enough vectors exist the search is
+exact. After that a spherical k-means coarse quantizer (IVF) is trained and
+the vectors are copied into a layout grouped by cluster with per-cluster
+offsets, so a search only reads the contiguous slices of the clusters it
+probes plus the short tail of vectors added since the last rebuild.
+
+The layout is regrouped whenever the tail grows past regroup_size, and the
+quantizer is retrained with more clusters each time the index doubles.
+Rebuilds write a new layout directory and switch to it atomically through
+meta.json; by default they run in a background thread so adds and searches
+are never blocked on them.
+"""
+import json
+import os
+import shutil
+import threading
+import uuid
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+class EmbeddingIndex:
+    """Incrementally updatable, memory-mapped cosine similarity index"""
+
+    def __init__(
+        self,
+        directory: str,
+        dim: int,
+        nprobe: int = 8,
+        train_size: int = 10000,
+        regroup_size: int = 8192,
+        initial_capacity: int = 1024,
+        background: bool = True
+    ):
+        self.directory = directory
+        self.dim = dim
+        self.nprobe = nprobe
+        self.train_size = train_size
+        self.regroup_size = regroup_size
+        self.background = background
+        self.count = 0
+        self.capacity = initial_capacity
+        self.index_id = uuid.uuid4().hex
+        self.trained_count = 0
+        self._layout_name: Optional[str] = None
+        self._layout: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]] = None
+        self._lock = threading.Lock()
+        self._rebuilding = False
+        self._rebuild_thread: Optional[threading.Thread] = None
+
+        os.makedirs(directory, exist_ok=True)
+        self._meta_path = os.path.join(directory, "meta.json")
+        self._vectors_path = os.path.join(directory, "vectors.f16")
+
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path) as f:
+                meta = json.load(f)
+            if meta["dim"] != dim:
+                raise ValueError(
+                    f"Index at {directory} holds {meta['dim']}-d vectors, model produces {dim}-d; "
+                    "remove the directory to rebuild it"
+                )
+            self.index_id = meta["index_id"]
+            self.count = meta["count"]
+            self.capacity = meta["capacity"]
+            self.trained_count = meta["trained_count"]
+            self._layout_name = meta["layout"]
+            if self._layout_name:
+                self._layout = self._open_layout(self._layout_name)
+
+        self._open_vectors()
+        self._save_meta()
+
+    def __len__(self) -> int:
+        return self.count
+
+    @property
+    def trained(self) -> bool:
+        return self._layout is not None
+
+    @property
+    def nlist(self) -> int:
+        return 0 if self._layout is None else len(self._layout[0])
+
+    # Storage
+
+    def _open_vectors(self):
+        """Size the vector log to the current capacity and map it"""
+        with open(self._vectors_path, "ab") as f:
+            f.truncate(self.capacity * 2 * self.dim)
+        self._vectors = np.memmap(self._vectors_path, dtype=np.float16, mode="r+", shape=(self.capacity, self.dim))
+
+    def _grow(self, needed: int):
+        """Double the capacity of the vector log until it can hold needed rows"""
+        self._vectors.flush()
+        while self.capacity < needed:
+            self.capacity *= 2
+        # Searches and rebuilds holding the old mapping keep reading valid rows
+        self._open_vectors()
+
+    def _open_layout(self, name: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Map the centroids, per-cluster offsets, grouped vectors and their row ids"""
+        path = os.path.join(self.directory, name)
+        return (
+            np.load(os.path.join(path, "centroids.npy")),
+            np.load(os.path.join(path, "offsets.npy")),
+            np.load(os.path.join(path, "grouped.npy"), mmap_mode="r"),
+            np.load(os.path.join(path, "grouped_rows.npy"), mmap_mode="r"),
+        )
+
+    def _save_meta(self):
+        meta = {
+            "index_id": self.index_id,
+            "dim": self.dim,
+            "count": self.count,
+            "capacity": self.capacity,
+            "trained_count": self.trained_count,
+            "layout": self._layout_name,
+        }
+        tmp_path = self._meta_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self._meta_path)
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    # Updates
+
+    def add(self, vector: np.ndarray) -> int:
+        """Append a vector and return its row number"""
+        return int(self.add_batch(np.asarray(vector).reshape(1, self.dim))[0])
+
+    def add_batch(self, vectors: np.ndarray) -> np.ndarray:
+        """Append several vectors and return their row numbers"""
+        vectors = self._normalize(vectors).reshape(-1, self.dim)
+        with self._lock:
+            if self.count + len(vectors) > self.capacity:
+                self._grow(self.count + len(vectors))
+            rows = np.arange(self.count, self.count + len(vectors))
+            self._vectors[rows[0]:rows[-1] + 1] = vectors
+            self.count += len(vectors)
+            self._save_meta()
+            retrain = self._rebuild_due()
+            if retrain is not None:
+                self._rebuilding = True
+
+        if retrain is not None:
+            self._start_rebuild(retrain)
+        return rows
+
+    def _rebuild_due(self) -> Optional[bool]:
+        """Whether a retrain (True) or a regroup (False) is due, or None"""
+        if self._rebuilding:
+            return None
+        if self._layout is None:
+            return True if self.count >= self.train_size else None
+        if self.count >= 2 * self.trained_count:
+            return True
+        if self.count - len(self._layout[3]) >= self.regroup_size:
+            return False
+        return None
+
+    def _start_rebuild(self, retrain: bool):
+        if self.background:
+            self._rebuild_thread = threading.Thread(target=self._rebuild, args=(retrain,), daemon=True)
+            self._rebuild_thread.start()
+        else:
+            self._rebuild(retrain)
+
+    def train(self):
+        """Retrain the quantizer and regroup the layout synchronously"""
+        self.wait()
+        with self._lock:
+            self._rebuilding = True
+        self._rebuild(True)
+
+    def wait(self):
+        """Block until a background rebuild finishes"""
+        thread = self._rebuild_thread
+        if thread is not None:
+            thread.join()
+
+    # Rebuilds
+
+    def _nearest_centroids(self, vectors: np.ndarray, centroids: np.ndarray, chunk_size: int = 65536) -> np.ndarray:
+        labels = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), chunk_size):
+            chunk = np.asarray(vectors[start:start + chunk_size], dtype=np.float32)
+            labels[start:start + chunk_size] = np.argmax(chunk @ centroids.T, axis=-1)
+        return labels
+
+    def _kmeans(self, vectors: np.ndarray, count: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+        """Spherical k-means on a sample of the stored vectors"""
+        rng = np.random.default_rng(seed)
+        nlist = max(1, int(np.sqrt(count)))
+        sample_rows = np.sort(rng.choice(count, min(count, nlist * 32), replace=False))
+        sample = vectors[sample_rows].astype(np.float32)
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+        for _ in range(iterations):
+            labels = np.argmax(sample @ centroids.T, axis=-1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            non_empty = np.bincount(labels, minlength=nlist) > 0
+            centroids[non_empty] = self._normalize(sums[non_empty])
+        return centroids
+
+    def _rebuild(self, retrain: bool, chunk_size: int = 65536):
+        """Write a new layout grouped by cluster and switch to it"""
+        try:
+            with self._lock:
+                count = self.count
+                vectors = self._vectors
+                layout = self._layout
+
+            if retrain or layout is None:
+                centroids = self._kmeans(vectors, count)
+                labels = self._nearest_centroids(vectors[:count], centroids)
+                rows = np.arange(count)
+            else:
+                # Keep the existing assignments and only place the new tail
+                centroids, offsets, _, grouped_rows = layout
+                grouped_labels = np.repeat(np.arange(len(centroids), dtype=np.int32), np.diff(offsets))
+                tail_start = len(grouped_rows)
+                labels = np.concatenate([grouped_labels, self._nearest_centroids(vectors[tail_start:count], centroids)])
+                rows = np.concatenate([np.asarray(grouped_rows), np.arange(tail_start, count)])
+
+            order = np.argsort(labels, kind="stable")
+            grouped_rows = rows[order]
+            offsets = np.searchsorted(labels[order], np.arange(len(centroids) + 1)).astype(np.int64)
+
+            name = f"layout-{uuid.uuid4().hex[:12]}"
+            path = os.path.join(self.directory, name)
+            os.makedirs(path)
+            np.save(os.path.join(path, "centroids.npy"), centroids)
+            np.save(os.path.join(path, "offsets.npy"), offsets)
+            np.save(os.path.join(path, "grouped_rows.npy"), grouped_rows)
+            grouped = np.lib.format.open_memmap(
+                os.path.join(path, "grouped.npy"), mode="w+", dtype=np.float16, shape=(count, self.dim)
+            )
+            for start in range(0, count, chunk_size):
+                grouped[start:start + chunk_size] = vectors[grouped_rows[start:start + chunk_size]]
+            grouped.flush()
+            del grouped
+
+            with self._lock:
+                old_name = self._layout_name
+                self._layout_name = name
+                self._layout = self._open_layout(name)
+                if retrain or layout is None:
+                    self.trained_count = count
+                self._save_meta()
+            if old_name:
+                shutil.rmtree(os.path.join(self.directory, old_name), ignore_errors=True)
+        finally:
+            with self._lock:
+                self._rebuilding = False
+
+    # Search
+
+    def search(self, query: np.ndarray, k: int = 10, nprobe: Optional[int] = None) -> List[Tuple[int, float]]:
+        """Return up to k (row, cosine similarity) pairs, most similar first"""
+        query = self._normalize(query).reshape(self.dim)
+        with self._lock:
+            count = self.count
+            vectors = self._vectors
+            layout = self._layout
+        if count == 0:
+            return []
+
+        if layout is None:
+            rows = np.arange(count)
+            scores = vectors[:count].astype(np.float32) @ query
+        else:
+            centroids, offsets, grouped, grouped_rows = layout
+            nprobe = min(nprobe or self.nprobe, len(centroids))
+            probes = np.argpartition(-(centroids @ query), nprobe - 1)[:nprobe]
+
+            # Each probed cluster is one contiguous slice of the grouped layout
+            row_parts = []
+            score_parts = []
+            for cluster in probes:
+                start, end = offsets[cluster], offsets[cluster + 1]
+                if start < end:
+                    row_parts.append(grouped_rows[start:end])
+                    score_parts.append(grouped[start:end].astype(np.float32) @ query)
+
+            # Vectors added since the last rebuild are scanned exactly
+            tail_start = len(grouped_rows)
+            if tail_start < count:
+                row_parts.append(np.arange(tail_start, count))
+                score_parts.append(vectors[tail_start:count].astype(np.float32) @ query)
+
+            if not row_parts:
+                return []
+            rows = np.concatenate(row_parts)
+            scores = np.concatenate(score_parts)
+
+        k = min(k, len(rows))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(rows[i]), float(scores[i])) for i in top]
+
+    def flush(self):
+        """Write pending changes to disk"""
+        self._vectors.flush()
@@ -7,13 +7,18 @@ from io import BytesIO
 from PIL import Image
 import tensorflow as tf
 import os
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Tuple
 import logging
 from functools import lru_cache
+import queue
 from datetime import datetime
-from pymongo import MongoClient
-from pymongo.errors import ConnectionFailure, ServerSelectionTimeoutError
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import ConnectionFailure, ServerSelectionTimeoutError, OperationFailure
+from bson import ObjectId
 import traceback
+import threading
+import time
+from embedding_index import EmbeddingIndex
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -23,6 +28,114 @@ app = FastAPI(title="Potato Disease Classification API",
              description="API for classifying potato plant diseases",
              version="1.0.0")
 
+# Initialize model as None
+MODEL: Optional[tf.keras.Model] = None
+SCREENER: Optional[tf.lite.Interpreter] = None
+INFERENCE_MODEL: Optional[tf.keras.Model] = None
+INFERENCE_FN = None
+EMBEDDINGS_ENABLED = False
+EMBEDDING_INDEX: Optional[EmbeddingIndex] = None
+EMBEDDING_INDEX_RESTORED = threading.Event()  # Set once stored embeddings have been caught up
+CLASS_NAMES = ["Early Blight", "Late Blight", "Healthy"]
+
+# Constants
+MAX_FILE_SIZE = 5 * 1024 * 1024  # 5MB
+MAX_IMAGE_PIXELS = 4096 * 4096  # Refuse decompression bombs above ~16 megapixels
+UPLOAD_CHUNK_SIZE = 64 * 1024  # Read uploads in 64KB chunks
+MAX_REQUEST_SIZE = MAX_FILE_SIZE + 64 * 1024  # Upload plus room for multipart headers and form fields
+ALLOWED_EXTENSIONS = {"jpg", "jpeg", "png", "npy"}
+# Magic bytes identifying the accepted image formats
+IMAGE_SIGNATURES = {
+    b"\xff\xd8\xff": "JPEG",
+    b"\x89PNG\r\n\x1a\n": "PNG",
+    b"\x93NUMPY": "NPY",  # Pre-resized uint8 tensor saved with np.save
+}
+# Format each allowed extension must contain
+EXTENSION_FORMATS = {"jpg": "JPEG", "jpeg": "JPEG", "png": "PNG", "npy": "NPY"}
+MODEL_INPUT_SIZE = (256, 256)
+BATCH_SIZE = 32  # Optimal batch size for prediction
+TTA_VIEWS = 4  # Original image plus three flips
+BUFFER_POOL_SIZE = int(os.getenv("BUFFER_POOL_SIZE", "4"))  # Preallocated request batch buffers
+# Temperature fitted offline on a held-out set (see calibrate.py); 1.0 leaves confidences unchanged
+CALIBRATION_TEMPERATURE = float(os.getenv("CALIBRATION_TEMPERATURE", "1.0"))
+
+# Early-exit cascade: a small TFLite screener answers confident cases before the full model
+CASCADE_ENABLED = os.getenv("CASCADE_ENABLED", "false").lower() == "true"
+CASCADE_MODEL = os.getenv("CASCADE_MODEL", "2.tflite")
+CASCADE_THRESHOLD = float(os.getenv("CASCADE_THRESHOLD", "0.9"))
+THRESHOLD_DECIMALS = 2  # Thresholds are rounded so metrics track at most 101 of them
+
+# Similar-case retrieval over penultimate-layer embeddings
+EMBEDDING_INDEX_DIR = os.getenv("EMBEDDING_INDEX_DIR", os.path.join(os.path.dirname(__file__), "embedding_index"))
+SIMILAR_DEFAULT_K = 10
+SIMILAR_MAX_K = 50
+REBUILD_BATCH_SIZE = 10000  # Embeddings restored from MongoDB per index update
+
+# Per-stage counters for tuning the cascade; screener counters are kept per threshold
+SCREENER_METRICS: Dict[float, Dict[str, float]] = {}
+FULL_MODEL_METRICS: Dict[str, float] = {"requests": 0, "total_latency_ms": 0.0}
+
+# Let PIL refuse oversized images too, in case decoding bypasses our header check
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+class UploadLimitMiddleware:
+    """Reject oversized request bodies before Starlette parses and spools the multipart form.
+    
+    Requests declaring a Content-Length above the limit are refused without
+    reading the body; otherwise body bytes are counted as they arrive and the
+    request is cut off as soon as the running total passes the limit.
+    """
+    
+    def __init__(self, app, limit: int):
+        self.app = app
+        self.limit = limit
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > self.limit:
+            await self.reject(scope, receive, send)
+            return
+        
+        received = 0
+        exceeded = False
+        
+        async def limited_receive():
+            nonlocal received, exceeded
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.limit:
+                    # Stop feeding the form parser; the app's own error response is discarded below
+                    exceeded = True
+                    return {"type": "http.disconnect"}
+            return message
+        
+        async def guarded_send(message):
+            if not exceeded:
+                await send(message)
+        
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not exceeded:
+                raise
+        
+        if exceeded:
+            await self.reject(scope, receive, send)
+    
+    async def reject(self, scope, receive, send):
+        response = JSONResponse(
+            status_code=400,
+            content={"detail": f"File size exceeds maximum limit of {MAX_FILE_SIZE/1024/1024}MB"}
+        )
+        await response(scope, receive, send)
+
+app.add_middleware(UploadLimitMiddleware, limit=MAX_REQUEST_SIZE)
+
 # Get allowed origins from environment variable or use defaults
 origins_env = os.getenv("ALLOWED_ORIGINS", "")
 if origins_env:
@@ -39,15 +152,6 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize model as None
-MODEL: Optional[tf.keras.Model] = None
-CLASS_NAMES = ["Early Blight", "Late Blight", "Healthy"]
-
-# Constants
-MAX_FILE_SIZE = 5 * 1024 * 1024  # 5MB
-ALLOWED_EXTENSIONS = {"jpg", "jpeg", "png"}
-MODEL_INPUT_SIZE = (256, 256)
-BATCH_SIZE = 32  # Optimal batch size for prediction
 
 # Cache the model in memory
 @lru_cache(maxsize=1)
@@ -60,7 +164,7 @@ def get_model() -> tf.keras.Model:
 
 def load_model() -> Optional[tf.keras.Model]:
     """Load the ML model and handle potential errors"""
-    global MODEL
+    global MODEL, INFERENCE_MODEL, INFERENCE_FN, EMBEDDINGS_ENABLED
     try:
         # Enable mixed precision for faster computation
         tf.keras.mixed_precision.set_global_policy('mixed_float16')
@@ -95,6 +199,14 @@ def load_model() -> Optional[tf.keras.Model]:
         # Validate model input shape
         if len(MODEL.input_shape) != 4:
             raise ValueError("Invalid model input shape")
+        
+        INFERENCE_MODEL, EMBEDDINGS_ENABLED = build_inference_model(MODEL)
+        
+        # Trace once for any batch size so requests reuse the same graph
+        INFERENCE_FN = tf.function(
+            lambda pixels: INFERENCE_MODEL(pixels, training=False),
+            input_signature=[tf.TensorSpec(shape=(None, *MODEL_INPUT_SIZE, 3), dtype=tf.uint8)]
+        )
             
     except Exception as e:
         logger.error(f"Error loading model: {str(e)}")
@@ -102,11 +214,143 @@ def load_model() -> Optional[tf.keras.Model]:
     
     return MODEL
 
+def build_inference_model(model: tf.keras.Model) -> Tuple[tf.keras.Model, bool]:
+    """Wrap the model to take uint8 pixels, with the [0,1] normalization folded
+    into the graph, and to also return the penultimate-layer embeddings when
+    the architecture allows it"""
+    pixels = tf.keras.Input(shape=(*MODEL_INPUT_SIZE, 3), dtype=tf.uint8)
+    scaled = tf.keras.layers.Rescaling(1.0 / 255, dtype="float32")(pixels)
+    
+    # Expose the penultimate layer alongside the predictions in a single forward pass
+    try:
+        features = tf.keras.Model(
+            inputs=model.inputs,
+            outputs=[model.layers[-2].output, model.output]
+        )
+        return tf.keras.Model(pixels, features(scaled)), True
+    except Exception as e:
+        logger.warning(f"Embedding extraction unavailable: {str(e)}")
+        return tf.keras.Model(pixels, model(scaled)), False
+
+def load_screener() -> Optional[tf.lite.Interpreter]:
+    """Load the TFLite screener model used by the cascade"""
+    global SCREENER
+    try:
+        # Try Docker path first, then fall back to local development path
+        docker_screener_path = os.path.join("/app/tf-lite-models", CASCADE_MODEL)
+        local_screener_path = os.path.join(os.path.dirname(__file__), "..", "tf-lite-models", CASCADE_MODEL)
+        
+        if os.path.exists(docker_screener_path):
+            screener_path = docker_screener_path
+        elif os.path.exists(local_screener_path):
+            screener_path = local_screener_path
+        else:
+            raise FileNotFoundError(f"Screener model not found at {docker_screener_path} or {local_screener_path}")
+        
+        SCREENER = tf.lite.Interpreter(model_path=screener_path)
+        SCREENER.allocate_tensors()
+        logger.info(f"Cascade screener loaded from {screener_path}")
+        
+    except Exception as e:
+        logger.error(f"Error loading screener model: {str(e)}")
+        raise RuntimeError(f"Failed to load screener model: {str(e)}")
+    
+    return SCREENER
+
+def get_screener() -> tf.lite.Interpreter:
+    """Get the screener interpreter, loading it on first use"""
+    if SCREENER is None:
+        load_screener()
+    return SCREENER
+
+def init_embedding_index():
+    """Open (or create) the on-disk embedding index"""
+    global EMBEDDING_INDEX
+    if not EMBEDDINGS_ENABLED:
+        logger.warning("Embedding model not available, similarity search disabled")
+        return
+    try:
+        dim = INFERENCE_MODEL.output_shape[0][-1]
+        EMBEDDING_INDEX = EmbeddingIndex(EMBEDDING_INDEX_DIR, dim)
+        logger.info(f"Embedding index opened at {EMBEDDING_INDEX_DIR} with {len(EMBEDDING_INDEX)} vectors")
+    except Exception as e:
+        logger.error(f"Failed to open embedding index: {str(e)}")
+        EMBEDDING_INDEX = None
+        return
+    
+    # Catch the index up with MongoDB in the background so startup is not held up.
+    # Records saved after the cutoff are indexed by /predict itself
+    cutoff = ObjectId()
+    threading.Thread(target=rebuild_embedding_index, args=(cutoff,), daemon=True).start()
+
+def rebuild_embedding_index(cutoff: ObjectId):
+    """Add the stored embeddings not yet linked to this index and point their records at the new rows.
+    
+    A fresh index (e.g. after a redeploy) is refilled completely. An index
+    whose restore was interrupted, or whose records failed to link, picks
+    up the remaining records on the next startup.
+    """
+    db = get_database()
+    if db is None:
+        logger.warning("MongoDB not initialized, embedding index not restored")
+        EMBEDDING_INDEX_RESTORED.set()
+        return
+    
+    collection = db["predictions"]
+    restored = 0
+    
+    def restore(ids, vectors):
+        rows = EMBEDDING_INDEX.add_batch(np.stack(vectors))
+        collection.bulk_write([
+            UpdateOne(
+                {"_id": record_id},
+                {"$set": {"embedding_index_id": EMBEDDING_INDEX.index_id, "embedding_row": int(row)}}
+            )
+            for record_id, row in zip(ids, rows)
+        ], ordered=False)
+    
+    try:
+        ids, vectors = [], []
+        unlinked = {
+            "embedding": {"$type": "binData"},
+            "embedding_index_id": {"$ne": EMBEDDING_INDEX.index_id},
+            "_id": {"$lt": cutoff}
+        }
+        for record in collection.find(unlinked, {"embedding": 1}):
+            vector = np.frombuffer(record["embedding"], dtype=np.float16)
+            if len(vector) != EMBEDDING_INDEX.dim:
+                continue  # Produced by a model with a different embedding size
+            ids.append(record["_id"])
+            vectors.append(vector)
+            if len(ids) == REBUILD_BATCH_SIZE:
+                restore(ids, vectors)
+                restored += len(ids)
+                ids, vectors = [], []
+        if ids:
+            restore(ids, vectors)
+            restored += len(ids)
+        logger.info(f"Restored {restored} embeddings from MongoDB into index {EMBEDDING_INDEX.index_id}")
+    except Exception as e:
+        logger.error(f"Failed to rebuild embedding index from MongoDB: {str(e)}")
+        logger.error(traceback.format_exc())
+    finally:
+        # Serve what was restored; the rest is picked up on the next startup
+        EMBEDDING_INDEX_RESTORED.set()
+
 @app.on_event("startup")
 async def startup():
     """Initialize the model and MongoDB when the application starts"""
     load_model()
+    if CASCADE_ENABLED:
+        load_screener()
     init_mongodb()
+    init_embedding_index()
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Flush the embedding index to disk"""
+    if EMBEDDING_INDEX is not None:
+        EMBEDDING_INDEX.flush()
 
 # Initialize MongoDB client as None
 MONGO_CLIENT: Optional[MongoClient] = None
@@ -142,6 +386,16 @@ def init_mongodb():
         MONGO_CLIENT.admin.command('ping')
         MONGO_DB = MONGO_CLIENT[db_name]
         logger.info(f"Successfully connected to MongoDB at {mongo_uri}")
+        
+        # Similar-case lookups fetch predictions by index id and row; a row is unique within an index
+        try:
+            MONGO_DB["predictions"].create_index(
+                [("embedding_index_id", 1), ("embedding_row", 1)],
+                unique=True,
+                partialFilterExpression={"embedding_index_id": {"$type": "string"}}
+            )
+        except Exception as e:
+            logger.warning(f"Failed to create embedding index on predictions: {str(e)}")
     except (ConnectionFailure, ServerSelectionTimeoutError) as e:
         logger.error(f"Failed to connect to MongoDB: {str(e)}")
         MONGO_CLIENT = None
@@ -168,35 +422,276 @@ def save_prediction_to_mongodb(prediction_data: Dict[str, Any]):
         logger.error(traceback.format_exc())
         return False
 
+def index_prediction_embedding(record_id: ObjectId, embedding: np.ndarray):
+    """Add a saved prediction's embedding to the index and point the record at its row"""
+    if EMBEDDING_INDEX is None:
+        return
+    try:
+        row = EMBEDDING_INDEX.add(embedding)
+        get_database()["predictions"].update_one(
+            {"_id": record_id},
+            {"$set": {"embedding_index_id": EMBEDDING_INDEX.index_id, "embedding_row": row}}
+        )
+    except Exception as e:
+        # The record stays unlinked and is indexed by the next startup's restore
+        logger.error(f"Failed to index prediction embedding: {str(e)}")
+        logger.error(traceback.format_exc())
+
 def is_valid_file_type(filename: str) -> bool:
     """Check if the file type is allowed"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def preprocess_image(contents: bytes) -> np.ndarray:
-    """Preprocess the image for model prediction with optimized operations"""
-    try:
-        # Use BytesIO for efficient memory handling
-        image = Image.open(BytesIO(contents))
-        
-        # Convert to RGB if needed
-        if image.mode != "RGB":
-            image = image.convert("RGB")
-        
-        # Resize with LANCZOS for better quality and performance
-        image = image.resize(MODEL_INPUT_SIZE, Image.LANCZOS)
+def sniff_image_format(header: bytes) -> Optional[str]:
+    """Identify the image format from its leading magic bytes"""
+    for signature, image_format in IMAGE_SIGNATURES.items():
+        if header.startswith(signature):
+            return image_format
+    return None
+
+async def read_upload_limited(file: UploadFile, limit: int = MAX_FILE_SIZE) -> bytearray:
+    """Read the upload in chunks, rejecting it as soon as it exceeds the limit
+    or its first bytes are not a supported image signature.
+    
+    UploadLimitMiddleware already caps the whole request body; this enforces
+    the limit on the file part itself.
+    """
+    size_error = HTTPException(
+        status_code=400,
+        detail=f"File size exceeds maximum limit of {limit/1024/1024}MB"
+    )
+    
+    buffer = bytearray()
+    while True:
+        chunk = await file.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
         
-        # Convert to numpy array efficiently
-        image_array = np.asarray(image, dtype=np.float32)
+        # Sniff the format from the first chunk before reading any further
+        if not buffer and sniff_image_format(chunk) is None:
+            raise HTTPException(
+                status_code=400,
+                detail="File content is not a supported image (expected JPEG, PNG or NPY)"
+            )
         
-        # Normalize to [0,1] range
-        image_array = image_array / 255.0
+        buffer.extend(chunk)
+        if len(buffer) > limit:
+            raise size_error
+    
+    if not buffer:
+        raise HTTPException(status_code=400, detail="Uploaded file is empty")
+    
+    return buffer
+
+def read_tensor_header(contents: bytes) -> Tuple[Tuple[int, ...], np.dtype, int]:
+    """Parse the shape, dtype and header length of a .npy payload without loading the array"""
+    buffer = BytesIO(contents)
+    version = np.lib.format.read_magic(buffer)
+    if version == (1, 0):
+        shape, _, dtype = np.lib.format.read_array_header_1_0(buffer)
+    else:
+        shape, _, dtype = np.lib.format.read_array_header_2_0(buffer)
+    return shape, dtype, buffer.tell()
+
+def validate_tensor_header(contents: bytes) -> Tuple[int, int]:
+    """Check that a tensor payload is already a uint8 image of the model input size"""
+    try:
+        shape, dtype, header_length = read_tensor_header(contents)
+    except Exception as e:
+        logger.error(f"Error reading tensor header: {str(e)}")
+        raise HTTPException(status_code=400, detail=f"Invalid tensor format: {str(e)}")
+    
+    expected_shape = (*MODEL_INPUT_SIZE, 3)
+    if tuple(shape) != expected_shape or dtype != np.uint8:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Tensor payload must be uint8 with shape {expected_shape}, got {dtype} {tuple(shape)}"
+        )
+    
+    # Reject truncated or padded payloads before np.load sees them
+    expected_size = header_length + int(np.prod(expected_shape))
+    if len(contents) != expected_size:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Tensor payload is {len(contents)} bytes, expected {expected_size}"
+        )
+    
+    height, width = shape[:2]
+    return width, height
+
+def validate_image_header(contents: bytes) -> Tuple[int, int]:
+    """Read the image dimensions from the header without decoding the pixels"""
+    if sniff_image_format(contents) == "NPY":
+        return validate_tensor_header(contents)
+    
+    try:
+        # Image.open only parses the header; pixel data is decoded lazily
+        with Image.open(BytesIO(contents)) as image:
+            width, height = image.size
+    except Exception as e:
+        logger.error(f"Error reading image header: {str(e)}")
+        raise HTTPException(status_code=400, detail=f"Invalid image format: {str(e)}")
+    
+    if width <= 0 or height <= 0 or width * height > MAX_IMAGE_PIXELS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Image dimensions {width}x{height} exceed maximum of {MAX_IMAGE_PIXELS} pixels"
+        )
+    
+    return width, height
+
+class BufferPool:
+    """Reusable uint8 batch buffers, so requests decode into preallocated
+    memory instead of allocating fresh arrays each time"""
+    
+    def __init__(self, shape: Tuple[int, ...], size: int):
+        self.shape = shape
+        self.size = size
+        self._free = queue.LifoQueue()
+        for _ in range(size):
+            self._free.put(np.empty(shape, dtype=np.uint8))
+    
+    def acquire(self) -> np.ndarray:
+        """Take a free buffer, allocating a temporary one if the pool is exhausted"""
+        try:
+            return self._free.get_nowait()
+        except queue.Empty:
+            return np.empty(self.shape, dtype=np.uint8)
+    
+    def release(self, buffer: np.ndarray):
+        """Return a buffer to the pool, dropping it if the pool is already full"""
+        if self._free.qsize() < self.size:
+            self._free.put(buffer)
+
+BATCH_BUFFERS = BufferPool((TTA_VIEWS, *MODEL_INPUT_SIZE, 3), BUFFER_POOL_SIZE)
+
+def preprocess_image(contents: bytes, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """Decode and resize the image into a uint8 array for model prediction.
+    
+    When out is given, the pixels are written into it (typically a slot of a
+    pooled batch buffer) instead of a new array. Normalization happens inside
+    the model graph.
+    """
+    try:
+        # Pre-resized tensors skip decoding and resizing entirely
+        if sniff_image_format(contents) == "NPY":
+            image_array = np.load(BytesIO(contents), allow_pickle=False)
+        else:
+            # Use BytesIO for efficient memory handling
+            image = Image.open(BytesIO(contents))
+            
+            # Convert to RGB if needed
+            if image.mode != "RGB":
+                image = image.convert("RGB")
+            
+            # Resize with LANCZOS for better quality and performance
+            image = image.resize(MODEL_INPUT_SIZE, Image.LANCZOS)
+            image_array = np.asarray(image)
         
-        return image_array
+        if out is None:
+            return image_array
+        np.copyto(out, image_array)
+        return out
         
     except Exception as e:
         logger.error(f"Error preprocessing image: {str(e)}")
         raise ValueError(f"Invalid image format: {str(e)}")
 
+def fill_tta_views(batch: np.ndarray) -> np.ndarray:
+    """Write deterministic flips of batch[0] into the following slots and return the filled views.
+    
+    These are the fixed counterparts of the RandomFlip("horizontal_and_vertical")
+    augmentation the model was trained with, so every view stays in-distribution.
+    """
+    image_array = batch[0]
+    np.copyto(batch[1], image_array[:, ::-1])  # Horizontal flip
+    np.copyto(batch[2], image_array[::-1, :])  # Vertical flip
+    np.copyto(batch[3], image_array[::-1, ::-1])  # Both flips (180 degree rotation)
+    return batch[:TTA_VIEWS]
+
+def calibrate_probabilities(probabilities: np.ndarray, temperature: float = CALIBRATION_TEMPERATURE) -> np.ndarray:
+    """Apply temperature scaling to softmax outputs"""
+    logits = np.log(np.clip(probabilities.astype(np.float64), 1e-7, 1.0)) / temperature
+    logits -= logits.max(axis=-1, keepdims=True)
+    scaled = np.exp(logits)
+    return scaled / scaled.sum(axis=-1, keepdims=True)
+
+def fit_temperature(probabilities: np.ndarray, labels: np.ndarray) -> float:
+    """Fit the calibration temperature offline by minimizing negative log-likelihood
+    over a held-out set of model outputs and their true class indices"""
+    labels = np.asarray(labels, dtype=np.int64)
+    best_temperature, best_nll = 1.0, np.inf
+    for temperature in np.linspace(0.25, 5.0, 96):
+        calibrated = calibrate_probabilities(probabilities, temperature)
+        nll = -np.mean(np.log(np.clip(calibrated[np.arange(len(labels)), labels], 1e-12, 1.0)))
+        if nll < best_nll:
+            best_temperature, best_nll = float(temperature), nll
+    return best_temperature
+
+def run_screener(img_batch: np.ndarray) -> np.ndarray:
+    """Score a single-image uint8 batch with the TFLite screener"""
+    interpreter = get_screener()
+    input_details = interpreter.get_input_details()[0]
+    output_details = interpreter.get_output_details()[0]
+    
+    interpreter.set_tensor(
+        input_details["index"],
+        img_batch.astype(input_details["dtype"])  # TFLite models rescale 0-255 inputs internally
+    )
+    interpreter.invoke()
+    return interpreter.get_tensor(output_details["index"])
+
+def get_screener_metrics(threshold: float) -> Dict[str, float]:
+    """Get the screener counters for a threshold, creating them on first use"""
+    return SCREENER_METRICS.setdefault(
+        threshold,
+        {"requests": 0, "accepted": 0, "escalated_agreed": 0, "total_latency_ms": 0.0}
+    )
+
+def record_stage_latency(metrics: Dict[str, float], start_time: float) -> float:
+    """Add the elapsed time since start_time to a stage's metrics"""
+    latency_ms = (time.perf_counter() - start_time) * 1000
+    metrics["requests"] += 1
+    metrics["total_latency_ms"] += latency_ms
+    return latency_ms
+
+def run_full_model(img_batch: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """Score a uint8 batch with the full model, returning predictions and embeddings when available"""
+    # The contiguous uint8 batch is handed to TensorFlow as-is
+    outputs = INFERENCE_FN(img_batch)
+    if not EMBEDDINGS_ENABLED:
+        return outputs.numpy(), None
+    embeddings, predictions = outputs
+    return predictions.numpy(), embeddings.numpy()
+
+async def read_image_upload(file: UploadFile) -> Tuple[bytes, int, int]:
+    """Validate an uploaded image and return its contents and dimensions"""
+    # Validate file presence
+    if not file:
+        raise HTTPException(status_code=400, detail="No file uploaded")
+    
+    # Validate file type before reading any of the body
+    if not is_valid_file_type(file.filename):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid file type. Allowed types: {', '.join(ALLOWED_EXTENSIONS)}"
+        )
+    
+    # Validate file size and magic bytes while streaming the body
+    contents = await read_upload_limited(file)
+    
+    # The content must match the extension it was uploaded with
+    extension = file.filename.rsplit('.', 1)[1].lower()
+    if sniff_image_format(contents) != EXTENSION_FORMATS[extension]:
+        raise HTTPException(
+            status_code=400,
+            detail=f"File content does not match its .{extension} extension"
+        )
+    
+    # Validate image dimensions from the header before decoding
+    image_width, image_height = validate_image_header(contents)
+    
+    return contents, image_width, image_height
+
 @app.get("/ping")
 async def ping() -> Dict[str, Any]:
     """Health check endpoint"""
@@ -206,33 +701,43 @@ async def ping() -> Dict[str, Any]:
         "model_loaded": model is not None,
         "model_info": {
             "input_shape": model.input_shape if model else None,
+            "preferred_input_size": list(MODEL_INPUT_SIZE),
+            "accepted_formats": sorted(ALLOWED_EXTENSIONS),
             "class_names": CLASS_NAMES,
+            "calibration_temperature": CALIBRATION_TEMPERATURE,
             "mixed_precision": tf.keras.mixed_precision.global_policy().name
         }
     }
 
 @app.post("/predict")
 async def predict(
-    file: UploadFile = File(...)
+    file: UploadFile = File(...),
+    tta: bool = False,
+    cascade: Optional[bool] = None,
+    cascade_threshold: Optional[float] = None
 ) -> Dict[str, Any]:
-    """Predict the disease class for an uploaded image with optimized processing"""
-    # Validate file presence
-    if not file:
-        raise HTTPException(status_code=400, detail="No file uploaded")
+    """Predict the disease class for an uploaded image with optimized processing.
     
-    # Validate file size
-    contents = await file.read()
-    file_size = len(contents)
-    if file_size > MAX_FILE_SIZE:
-        raise HTTPException(status_code=400, detail=f"File size exceeds maximum limit of {MAX_FILE_SIZE/1024/1024}MB")
+    With tta=true, flipped views of the image are scored in a single batched
+    call and their probabilities averaged.
     
-    # Validate file type
-    if not is_valid_file_type(file.filename):
-        raise HTTPException(
-            status_code=400,
-            detail=f"Invalid file type. Allowed types: {', '.join(ALLOWED_EXTENSIONS)}"
-        )
+    With the cascade enabled (CASCADE_ENABLED or cascade=true), the TFLite
+    screener answers first and only images below the confidence threshold
+    are escalated to the full model. The threshold is rounded to two
+    decimals, so every request is counted under the threshold it ran with.
+    """
+    use_cascade = CASCADE_ENABLED if cascade is None else cascade
+    threshold = CASCADE_THRESHOLD if cascade_threshold is None else cascade_threshold
+    
+    # Validate the cascade threshold
+    if not 0.0 <= threshold <= 1.0:
+        raise HTTPException(status_code=400, detail="cascade_threshold must be between 0 and 1")
+    threshold = round(threshold, THRESHOLD_DECIMALS)
+    
+    contents, image_width, image_height = await read_image_upload(file)
+    file_size = len(contents)
     
+    buffer = BATCH_BUFFERS.acquire()
     try:
         # Get cached model instance
         model = get_model()
@@ -240,26 +745,74 @@ async def predict(
             logger.error("Model not loaded")
             raise HTTPException(status_code=500, detail="Model not loaded")
         
-        # Preprocess image
-        processed_image = preprocess_image(contents)
+        # Decode the image straight into the first slot of the batch buffer
+        preprocess_image(contents, out=buffer[0])
         
-        # Prepare batch for prediction
-        img_batch = np.expand_dims(processed_image, 0)
+        stage = "full_model"
+        screener_confidence = None
+        screener_class = None
+        embeddings = None
+        latency_ms = {}
         
-        try:
-            # Make prediction with optimized settings
-            predictions = model.predict(img_batch, verbose=0)
-        except Exception as pred_error:
-            logger.error(f"Prediction error: {str(pred_error)}")
-            raise HTTPException(status_code=500, detail="Error during prediction")
+        if use_cascade:
+            # Let the screener answer confident cases on its own
+            img_batch = buffer[:1]
+            screener_metrics = get_screener_metrics(threshold)
+            try:
+                start_time = time.perf_counter()
+                predictions = run_screener(img_batch)
+                latency_ms["screener"] = record_stage_latency(screener_metrics, start_time)
+            except Exception as screen_error:
+                logger.error(f"Screener error: {str(screen_error)}")
+                raise HTTPException(status_code=500, detail="Error during screening")
+            
+            screener_confidence = float(np.max(predictions[0]))
+            screener_class = CLASS_NAMES[np.argmax(predictions[0])]
+            if screener_confidence >= threshold:
+                stage = "screener"
+                screener_metrics["accepted"] += 1
+        
+        if stage == "full_model":
+            # Prepare batch for prediction
+            if tta:
+                img_batch = fill_tta_views(buffer)
+            else:
+                img_batch = buffer[:1]
+            
+            try:
+                # Make prediction with optimized settings
+                start_time = time.perf_counter()
+                predictions, embeddings = run_full_model(img_batch)
+                latency_ms["full_model"] = record_stage_latency(FULL_MODEL_METRICS, start_time)
+            except Exception as pred_error:
+                logger.error(f"Prediction error: {str(pred_error)}")
+                raise HTTPException(status_code=500, detail="Error during prediction")
+        
+        # The temperature is fitted on single full-model views, so each TTA view
+        # is calibrated before averaging rather than the already smoother mean
+        if stage == "full_model":
+            predictions = calibrate_probabilities(predictions)
+        probabilities = np.mean(predictions, axis=0)
+        tta_used = tta and stage == "full_model"
+        # Screener confidences are not calibrated, so no temperature is reported for them
+        temperature = CALIBRATION_TEMPERATURE if stage == "full_model" else None
+        
+        # Average the view embeddings; the vector is indexed once its record is saved
+        embedding = None
+        if embeddings is not None:
+            embedding = np.mean(embeddings, axis=0).astype(np.float16)
+        
+        predicted_class = CLASS_NAMES[np.argmax(probabilities)]
+        confidence = float(np.max(probabilities))
         
-        predicted_class = CLASS_NAMES[np.argmax(predictions[0])]
-        confidence = float(np.max(predictions[0]))
+        # Track how often the full model agrees with the screener on escalated images
+        if screener_class is not None and stage == "full_model" and screener_class == predicted_class:
+            screener_metrics["escalated_agreed"] += 1
         
         # Get confidence scores for all classes
         class_confidences = {
             class_name: float(conf)
-            for class_name, conf in zip(CLASS_NAMES, predictions[0])
+            for class_name, conf in zip(CLASS_NAMES, probabilities)
         }
         
         # Prepare prediction data for MongoDB
@@ -269,22 +822,37 @@ async def predict(
             "class_confidences": class_confidences,
             "file_metadata": {
                 "filename": file.filename,
-                "size": file_size
+                "size": file_size,
+                "width": image_width,
+                "height": image_height
             },
             "processing_details": {
                 "input_shape": img_batch.shape,
-                "prediction_shape": predictions.shape
+                "prediction_shape": predictions.shape,
+                "calibration_temperature": temperature,
+                "cascade_stage": stage,
+                "screener_confidence": screener_confidence,
+                "screener_class": screener_class
             },
+            "embedding": embedding.tobytes() if embedding is not None else None,
+            "embedding_index_id": None,
+            "embedding_row": None,
             "timestamp": datetime.utcnow()
         }
         
         # Save to MongoDB asynchronously (non-blocking)
-        save_prediction_to_mongodb(prediction_data)
+        saved = save_prediction_to_mongodb(prediction_data)
+        
+        # Only saved records are indexed, so every row /similar finds has a record
+        if saved and embedding is not None:
+            index_prediction_embedding(prediction_data["_id"], embedding)
         
         return {
             'class': predicted_class,
             'confidence': confidence,
             'class_confidences': class_confidences,
+            'tta': tta_used,
+            'stage': stage,
             'status': 'success',
             'details': {
                 'file_name': file.filename,
@@ -292,7 +860,17 @@ async def predict(
                 'input_shape': img_batch.shape,
                 'prediction_shape': predictions.shape,
                 'processing_info': {
-                    'mixed_precision': tf.keras.mixed_precision.global_policy().name
+                    'mixed_precision': tf.keras.mixed_precision.global_policy().name,
+                    'tta': tta_used,
+                    'tta_views': len(img_batch),
+                    'calibration_temperature': temperature,
+                    'cascade': {
+                        'enabled': use_cascade,
+                        'threshold': threshold if use_cascade else None,
+                        'screener_confidence': screener_confidence,
+                        'screener_class': screener_class
+                    },
+                    'latency_ms': latency_ms
                 }
             }
         }
@@ -310,6 +888,123 @@ async def predict(
                 'type': 'UnexpectedError'
             }
         )
+    finally:
+        BATCH_BUFFERS.release(buffer)
+
+@app.post("/similar")
+async def similar(
+    file: UploadFile = File(...),
+    k: int = SIMILAR_DEFAULT_K
+) -> Dict[str, Any]:
+    """Retrieve the past predictions whose images are most similar to the uploaded one"""
+    # Validate k
+    if k < 1 or k > SIMILAR_MAX_K:
+        k = SIMILAR_DEFAULT_K
+    
+    if not EMBEDDINGS_ENABLED or EMBEDDING_INDEX is None:
+        raise HTTPException(status_code=503, detail="Similarity search not available")
+    if not EMBEDDING_INDEX_RESTORED.is_set():
+        raise HTTPException(status_code=503, detail="Similarity index is being restored from MongoDB, try again shortly")
+    
+    contents, _, _ = await read_image_upload(file)
+    
+    try:
+        # Get database connection
+        db = get_database()
+        if db is None:
+            logger.warning("MongoDB not initialized")
+            raise HTTPException(
+                status_code=503,
+                detail="Database not available"
+            )
+        
+        # Embed the query image
+        buffer = BATCH_BUFFERS.acquire()
+        try:
+            preprocess_image(contents, out=buffer[0])
+            _, embeddings = run_full_model(buffer[:1])
+        finally:
+            BATCH_BUFFERS.release(buffer)
+        
+        # Search the index
+        start_time = time.perf_counter()
+        matches = EMBEDDING_INDEX.search(embeddings[0], k)
+        search_ms = (time.perf_counter() - start_time) * 1000
+        
+        # Fetch the matching prediction records
+        collection = db["predictions"]
+        records = {
+            record["embedding_row"]: record
+            for record in collection.find(
+                {
+                    "embedding_index_id": EMBEDDING_INDEX.index_id,
+                    "embedding_row": {"$in": [row for row, _ in matches]}
+                },
+                {"_id": 0, "embedding": 0}
+            )
+        }
+        
+        return {
+            "status": "success",
+            "data": [
+                {**records[row], "similarity": similarity}
+                for row, similarity in matches
+                if row in records
+            ],
+            "search_info": {
+                "k": k,
+                "index_id": EMBEDDING_INDEX.index_id,
+                "indexed_vectors": len(EMBEDDING_INDEX),
+                "search_ms": search_ms
+            }
+        }
+        
+    except HTTPException as he:
+        raise he
+    except OperationFailure as e:
+        logger.error(f"MongoDB authorization error: {str(e)}")
+        raise HTTPException(
+            status_code=503,
+            detail="Database authentication failed"
+        )
+    except Exception as e:
+        logger.error(f"Failed to retrieve similar predictions: {str(e)}")
+        logger.error(traceback.format_exc())
+        raise HTTPException(
+            status_code=500,
+            detail="Internal server error while retrieving similar predictions"
+        )
+
+@app.get("/metrics/cascade")
+async def get_cascade_metrics() -> Dict[str, Any]:
+    """Per-stage hit rate and latency of the prediction cascade.
+    
+    Screener counters are reported separately for every threshold requests
+    were made with, so a threshold sweep does not mix its results.
+    """
+    full_model = FULL_MODEL_METRICS
+    screener_stats = []
+    for threshold, screener in sorted(SCREENER_METRICS.items()):
+        escalated = screener["requests"] - screener["accepted"]
+        screener_stats.append({
+            "threshold": threshold,
+            "requests": screener["requests"],
+            "accepted": screener["accepted"],
+            "escalated": escalated,
+            "hit_rate": screener["accepted"] / screener["requests"] if screener["requests"] else None,
+            "escalated_agreement": screener["escalated_agreed"] / escalated if escalated else None,
+            "avg_latency_ms": screener["total_latency_ms"] / screener["requests"] if screener["requests"] else None
+        })
+    
+    return {
+        "enabled": CASCADE_ENABLED,
+        "threshold": CASCADE_THRESHOLD,
+        "screener": screener_stats,
+        "full_model": {
+            "requests": full_model["requests"],
+            "avg_latency_ms": full_model["total_latency_ms"] / full_model["requests"] if full_model["requests"] else None
+        }
+    }
 
 @app.get("/predictions")
 async def get_predictions(
@@ -340,7 +1035,7 @@ async def get_predictions(
         collection = db["predictions"]
         predictions = list(collection.find(
             {},
-            {"_id": 0}  # Exclude MongoDB _id field
+            {"_id": 0, "embedding": 0}  # Exclude MongoDB _id field and binary embedding
         ).skip(skip).limit(page_size).sort("timestamp", -1))  # Sort by timestamp descending
         
         # Get total count for pagination info
@@ -0,0 +1,104 @@
+import numpy as np
+import pytest
+
+from embedding_index import EmbeddingIndex
+
+DIM = 16
+
+def clustered_vectors(count: int, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(20, DIM))
+    return centers[rng.integers(0, len(centers), count)] + 0.1 * rng.normal(size=(count, DIM))
+
+def make_index(path, **kwargs) -> EmbeddingIndex:
+    options = {"train_size": 200, "regroup_size": 64, "initial_capacity": 16, "background": False}
+    options.update(kwargs)
+    return EmbeddingIndex(str(path), DIM, **options)
+
+def test_add_and_exact_search(tmp_path):
+    index = make_index(tmp_path)
+    vectors = clustered_vectors(50)
+    rows = [index.add(vector) for vector in vectors]
+
+    assert rows == list(range(50))
+    assert not index.trained
+    results = index.search(vectors[7], k=3)
+    assert results[0][0] == 7
+    assert results[0][1] == pytest.approx(1.0, abs=1e-3)
+    assert [score for _, score in results] == sorted((score for _, score in results), reverse=True)
+
+def test_search_empty_index(tmp_path):
+    assert make_index(tmp_path).search(np.ones(DIM)) == []
+
+def test_grow_beyond_initial_capacity(tmp_path):
+    index = make_index(tmp_path, initial_capacity=4)
+    vectors = clustered_vectors(100)
+    rows = index.add_batch(vectors[:10])
+    for vector in vectors[10:]:
+        index.add(vector)
+
+    assert list(rows) == list(range(10))
+    assert len(index) == 100
+    assert index.capacity >= 100
+    assert index.search(vectors[99], k=1)[0][0] == 99
+
+def test_trains_and_finds_neighbours_in_grouped_layout(tmp_path):
+    index = make_index(tmp_path)
+    vectors = clustered_vectors(1000)
+    index.add_batch(vectors)
+
+    assert index.trained
+    assert index.nlist >= int(np.sqrt(index.train_size))
+    for row in (0, 123, 999):
+        assert index.search(vectors[row], k=1, nprobe=4)[0][0] == row
+
+def test_retrains_with_more_clusters_as_index_doubles(tmp_path):
+    index = make_index(tmp_path)
+    vectors = clustered_vectors(2000)
+    index.add_batch(vectors[:200])
+    first_nlist = index.nlist
+    for start in range(200, 2000, 100):
+        index.add_batch(vectors[start:start + 100])
+
+    assert index.trained_count > 200
+    assert index.nlist > first_nlist
+    assert index.search(vectors[1999], k=1)[0][0] == 1999
+
+def test_tail_rows_are_searchable_before_regroup(tmp_path):
+    index = make_index(tmp_path, regroup_size=10000)
+    vectors = clustered_vectors(300)
+    index.add_batch(vectors[:250])
+    for vector in vectors[250:]:
+        index.add(vector)
+
+    assert index.search(vectors[290], k=1)[0][0] == 290
+
+def test_reopen_keeps_vectors_layout_and_id(tmp_path):
+    index = make_index(tmp_path)
+    vectors = clustered_vectors(500)
+    index.add_batch(vectors)
+    index.flush()
+
+    reopened = make_index(tmp_path)
+    assert reopened.index_id == index.index_id
+    assert len(reopened) == 500
+    assert reopened.trained
+    assert reopened.search(vectors[42], k=1)[0][0] == 42
+    assert reopened.add(vectors[0]) == 500
+
+def test_new_directory_gets_new_id(tmp_path):
+    assert make_index(tmp_path / "a").index_id != make_index(tmp_path / "b").index_id
+
+def test_dimension_mismatch_raises(tmp_path):
+    make_index(tmp_path).add(np.ones(DIM))
+    with pytest.raises(ValueError):
+        EmbeddingIndex(str(tmp_path), DIM + 1)
+
+def test_background_rebuild(tmp_path):
+    index = make_index(tmp_path, background=True)
+    vectors = clustered_vectors(400)
+    index.add_batch(vectors)
+    index.wait()
+
+    assert index.trained
+    assert index.search(vectors[5], k=1)[0][0] == 5
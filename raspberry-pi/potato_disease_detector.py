@@ -1,8 +1,10 @@
 import os
 import time
 from datetime import datetime
+from io import BytesIO
 from pathlib import Path
 import requests
+import numpy as np
 from PIL import Image
 import cv2
 from dotenv import load_dotenv
@@ -14,6 +16,9 @@ load_dotenv()
 API_URL = os.getenv('API_URL', 'http://192.168.0.225:8000')  # Replace with your API server IP
 CAPTURE_INTERVAL = int(os.getenv('CAPTURE_INTERVAL', '300'))  # Default 5 minutes
 SAVE_IMAGES = os.getenv('SAVE_IMAGES', 'true').lower() == 'true'
+UPLOAD_FORMAT = os.getenv('UPLOAD_FORMAT', 'jpeg').lower()  # 'jpeg' or 'npy' (raw uint8 tensor)
+JPEG_QUALITY = int(os.getenv('JPEG_QUALITY', '90'))
+DEFAULT_INPUT_SIZE = (256, 256)
 IMAGE_DIR = 'captured_images'
 
 class PotatoDiseaseDetector:
@@ -27,53 +32,66 @@ class PotatoDiseaseDetector:
         if SAVE_IMAGES:
             Path(IMAGE_DIR).mkdir(exist_ok=True)
 
+        # Ask the API which resolution the model expects
+        self.input_size = self.fetch_input_size()
+
+    def fetch_input_size(self):
+        """Get the model's preferred input size from the API, falling back to the default"""
+        try:
+            response = requests.get(f"{API_URL}/ping", timeout=10)
+            size = response.json()['model_info']['preferred_input_size']
+            return tuple(size)
+        except Exception as e:
+            print(f"Could not fetch preferred input size, using {DEFAULT_INPUT_SIZE}: {str(e)}")
+            return DEFAULT_INPUT_SIZE
+
     def capture_image(self):
-        """Capture an image and return its path"""
+        """Capture a frame and return it as an RGB PIL image"""
         # Capture frame
         ret, frame = self.camera.read()
         if not ret:
             raise RuntimeError("Failed to capture image from webcam")
         
-        # Save image
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        # Keep the full resolution frame on disk for record keeping
         if SAVE_IMAGES:
-            image_path = f"{IMAGE_DIR}/potato_{timestamp}.jpg"
-        else:
-            image_path = "temp_capture.jpg"
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            cv2.imwrite(f"{IMAGE_DIR}/potato_{timestamp}.jpg", frame)
             
-        cv2.imwrite(image_path, frame)
-        return image_path
+        return Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+
+    def encode_image(self, image):
+        """Resize the image to the model input size and encode it in memory for upload"""
+        image = image.resize(self.input_size, Image.Resampling.LANCZOS)
+        buffer = BytesIO()
+
+        if UPLOAD_FORMAT == 'npy':
+            np.save(buffer, np.asarray(image, dtype=np.uint8), allow_pickle=False)
+            return ('image.npy', buffer.getvalue(), 'application/octet-stream')
 
-    def analyze_image(self, image_path):
+        image.save(buffer, format='JPEG', quality=JPEG_QUALITY)
+        return ('image.jpg', buffer.getvalue(), 'image/jpeg')
+
+    def analyze_image(self, image):
         """Send image to API for analysis"""
         try:
-            # Prepare image for API
-            with Image.open(image_path) as img:
-                # Resize image if needed
-                max_size = (1024, 1024)
-                img.thumbnail(max_size, Image.Resampling.LANCZOS)
-                if not SAVE_IMAGES:
-                    img.save(image_path)
-
             # Send to API
-            with open(image_path, 'rb') as img_file:
-                files = {'file': ('image.jpg', img_file, 'image/jpeg')}
-                response = requests.post(f"{API_URL}/predict", files=files)
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    return {
-                        'success': True,
-                        'prediction': result.get('class'),
-                        'confidence': result.get('confidence'),
-                        'timestamp': datetime.now().isoformat()
-                    }
-                else:
-                    return {
-                        'success': False,
-                        'error': f"API Error: {response.status_code}",
-                        'timestamp': datetime.now().isoformat()
-                    }
+            files = {'file': self.encode_image(image)}
+            response = requests.post(f"{API_URL}/predict", files=files)
+            
+            if response.status_code == 200:
+                result = response.json()
+                return {
+                    'success': True,
+                    'prediction': result.get('class'),
+                    'confidence': result.get('confidence'),
+                    'timestamp': datetime.now().isoformat()
+                }
+            else:
+                return {
+                    'success': False,
+                    'error': f"API Error: {response.status_code}",
+                    'timestamp': datetime.now().isoformat()
+                }
 
         except Exception as e:
             return {
@@ -81,10 +99,6 @@ class PotatoDiseaseDetector:
                 'error': str(e),
                 'timestamp': datetime.now().isoformat()
             }
-        finally:
-            # Clean up temporary file
-            if not SAVE_IMAGES and os.path.exists(image_path):
-                os.remove(image_path)
 
     def run_continuous(self):
         """Run continuous monitoring"""
@@ -94,9 +108,9 @@ class PotatoDiseaseDetector:
         while True:
             try:
                 print("\nCapturing image...")
-                image_path = self.capture_image()
+                image = self.capture_image()
                 print("Analyzing image...")
-                result = self.analyze_image(image_path)
+                result = self.analyze_image(image)
                 
                 if result['success']:
                     print(f"Prediction: {result['prediction']}")